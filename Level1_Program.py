@@ -32,22 +32,28 @@ print("=== レベル1: 基本ライントレース ===")
 print("スタート！（中央ボタンで停止）")
 hub.speaker.beep(1000, 100)
 
+# ループ内で使うメソッドを事前に取得（属性検索を削減）
+read_reflection = color_sensor.reflection
+pressed = hub.buttons.pressed
+drive = robot.drive
+CENTER = Button.CENTER
+
 # メインループ
 while True:
     # 停止ボタンチェック
-    if Button.CENTER in hub.buttons.pressed():
+    if CENTER in pressed():
         break
     
     # センサー値を読む
-    reflection = color_sensor.reflection()
+    reflection = read_reflection()
     
     # ON/OFF制御
     if reflection < THRESHOLD:
         # 黒を検出 → 左に曲がる
-        robot.drive(BASE_SPEED, -TURN_RATE)
+        drive(BASE_SPEED, -TURN_RATE)
     else:
         # 白を検出 → 右に曲がる
-        robot.drive(BASE_SPEED, TURN_RATE)
+        drive(BASE_SPEED, TURN_RATE)
     
     wait(10)
 
@@ -10,6 +10,8 @@ from pybricks.parameters import Button, Direction, Port
 from pybricks.robotics import DriveBase
 from pybricks.tools import wait, StopWatch
 
+from calibration import calibrate_core
+
 # ハードウェアの初期化
 hub = PrimeHub()
 left_motor = Motor(Port.A, Direction.COUNTERCLOCKWISE)
@@ -27,84 +29,34 @@ last_error = 0      # 前回のエラー値（微分計算用）
 integral_limit = 100  # 積分項の制限値
 # ========================================================
 
-# キャリブレーション機能（レベル2から継承）
-def calibrate():
-    """白と黒の値を測定して、自動的にしきい値を設定する"""
-    print("=== キャリブレーション開始 ===")
-    
-    # 白の測定
-    hub.display.char("W")
-    print("白い地面にセンサーを置いて中央ボタンを押してください")
-    while not Button.CENTER in hub.buttons.pressed():
-        current = color_sensor.reflection()
-        print(f"現在の値: {current}%", end='\r')
-        wait(50)
-    
-    white_value = color_sensor.reflection()
-    print(f"\n白の値: {white_value}%")
-    hub.speaker.beep(1000, 100)
-    wait(500)
-    
-    # 黒の測定
-    hub.display.char("B")
-    print("黒いラインにセンサーを置いて中央ボタンを押してください")
-    while not Button.CENTER in hub.buttons.pressed():
-        current = color_sensor.reflection()
-        print(f"現在の値: {current}%", end='\r')
-        wait(50)
-    
-    black_value = color_sensor.reflection()
-    print(f"\n黒の値: {black_value}%")
-    hub.speaker.beep(1500, 100)
-    
-    # 目標値と閾値を計算
-    target = (white_value + black_value) / 2
-    
-    # レベル4で追加：閾値も保存（ライン検出用）
-    black_threshold = black_value + 5
-    white_threshold = white_value - 5
-    
-    print(f"目標値: {target}%")
-    print(f"黒閾値: {black_threshold}%, 白閾値: {white_threshold}%")
-    
-    hub.display.char("R")
-    hub.speaker.beep(2000, 200)
-    wait(500)
-    
-    return target, black_threshold, white_threshold
+# キャリブレーション機能（レベル2から継承、calibration.pyで共通化）
+# レベル4では include_thresholds=True でライン検出用の閾値も受け取る
 
 # ========== レベル4で変更: P制御からPID制御へ ==========
-def calculate_pid_control(sensor_value, target_value, kp, ki, kd):
+def calculate_pid_control(sensor_value, target_value, kp_q4, ki_q8, kd_q4):
     """
     完全なPID制御の計算
     P: 比例項（現在のエラー）
     I: 積分項（エラーの累積）
     D: 微分項（エラーの変化率）
+    ゲインは整数の固定小数点（Q4は16倍、Q8は256倍）で受け取る
     """
     global integral, last_error
     
     # エラーの計算
     error = sensor_value - target_value
     
-    # 積分項の計算（エラーの累積）
-    integral += error
-    if integral > integral_limit:
-        integral = integral_limit
-    elif integral < -integral_limit:
-        integral = -integral_limit
+    # 積分項の計算（エラーの累積、±integral_limitに制限）
+    integral = max(-integral_limit, min(integral + error, integral_limit))
     
     # 微分項の計算（エラーの変化率）
     derivative = error - last_error
     
     # PID制御の出力
-    turn_rate = (kp * error) + (ki * integral) + (kd * derivative)
+    turn_rate = ((kp_q4 * error + kd_q4 * derivative) >> 4) + ((ki_q8 * integral) >> 8)
     
     # 最大値の制限
-    max_turn = 250
-    if turn_rate > max_turn:
-        turn_rate = max_turn
-    elif turn_rate < -max_turn:
-        turn_rate = -max_turn
+    turn_rate = max(-MAX_TURN, min(turn_rate, MAX_TURN))
     
     # 次回のために記録
     last_error = error
@@ -123,14 +75,24 @@ def search_line(target_value):
     search_angles = [30, -60, 90, -120, 150]
     
     for angle in search_angles:
-        robot.turn(angle)
+        # 旋回完了を待たずに、旋回しながらラインを確認
+        robot.turn(angle, wait=False)
         
-        # ラインを発見したか確認
-        if color_sensor.reflection() < target_value:
-            print("ライン発見！")
-            hub.speaker.beep(2000, 100)
-            hub.display.char("R")
-            return True
+        while True:
+            # 旋回完了の判定は先に取り、完了後にも1回センサーを確認する
+            done = robot.done()
+            
+            # ラインを発見したか確認
+            if color_sensor.reflection() < target_value:
+                robot.stop()
+                print("ライン発見！")
+                hub.speaker.beep(2000, 100)
+                hub.display.char("R")
+                return True
+            
+            if done:
+                break
+            wait(5)
         
         wait(50)
     
@@ -143,6 +105,7 @@ def detect_sharp_curve(sensor_value, black_thresh, white_thresh):
     """
     急カーブの検出
     センサー値が極端な場合は急カーブと判定
+    （メインループでは同じ値を SHARP_LEFT_THRESHOLD / SHARP_RIGHT_THRESHOLD として事前計算して直接比較する）
     """
     if sensor_value < black_thresh + 5:
         return "sharp_left"
@@ -156,22 +119,28 @@ def adjust_speed(base_speed, error):
     エラーの大きさに応じて速度を調整
     カーブでは自動的に減速する
     """
-    speed = base_speed - abs(error) * 0.8
-    if speed < 50:
-        speed = 50
-    return speed
+    speed = base_speed - ((abs(error) * 13) >> 4)  # 0.8倍を整数演算で計算（13/16）
+    return speed if speed >= 50 else 50
 
 # パラメータ
 BASE_SPEED = 150    # 基本速度
-KP = 2.0           # 比例ゲイン
-KI = 0.02          # 積分ゲイン（レベル4で追加）
-KD = 0.8           # 微分ゲイン（レベル4で追加）
+KP_Q4 = 32         # 比例ゲイン 2.0 の16倍
+KI_Q8 = 5          # 積分ゲイン 0.02 の256倍（レベル4で追加）
+KD_Q4 = 13         # 微分ゲイン 0.8 の16倍（レベル4で追加）
+MAX_TURN = 250     # 最大旋回速度
 
 print("=== レベル4: 完全なPID制御ライントレース ===")
 print("新機能: PID制御、ライン探索、急カーブ対応")
 
 # キャリブレーション実行
-TARGET_VALUE, BLACK_THRESHOLD, WHITE_THRESHOLD = calibrate()
+TARGET_VALUE, BLACK_THRESHOLD, WHITE_THRESHOLD = calibrate_core(
+    hub, color_sensor, include_thresholds=True)
+
+# メインループで使う閾値と速度を事前計算
+LOST_THRESHOLD = WHITE_THRESHOLD + 5         # ライン見失い判定
+SHARP_LEFT_THRESHOLD = BLACK_THRESHOLD + 5   # 急左カーブ判定
+SHARP_RIGHT_THRESHOLD = WHITE_THRESHOLD - 5  # 急右カーブ判定
+CURVE_SPEED = BASE_SPEED // 2               # 急カーブ時の速度
 
 # タイマー開始
 timer = StopWatch()
@@ -181,59 +150,67 @@ print("スタート！（中央ボタンで停止）")
 print("PID制御で最高のパフォーマンスを発揮します")
 hub.speaker.beep(1000, 100)
 
+# ループ内で使うメソッドを事前に取得（属性検索を削減）
+read_reflection = color_sensor.reflection
+pressed = hub.buttons.pressed
+drive = robot.drive
+CENTER = Button.CENTER
+
 # メインループ
 while True:
     # 停止ボタンチェック
-    if Button.CENTER in hub.buttons.pressed():
+    if CENTER in pressed():
         break
     
     # センサー値を読む
-    reflection = color_sensor.reflection()
+    reflection = read_reflection()
     
-    # ========== レベル4で追加: ライン見失いチェック ==========
-    if reflection > WHITE_THRESHOLD + 5:
+    # ========== レベル4で追加: ライン見失い・急カーブ対応 ==========
+    # 見失い・急カーブ・通常制御を1つの分岐で判定
+    if reflection > LOST_THRESHOLD:
         lost_line_count += 1
         if lost_line_count > 5:  # 連続で見失った場合
             if not search_line(TARGET_VALUE):
                 break  # ライン発見失敗で終了
             lost_line_count = 0
-            integral = 0  # 積分項リセット
-    else:
-        lost_line_count = 0
-    
-    # ========== レベル4で追加: 急カーブ対応 ==========
-    curve_type = detect_sharp_curve(reflection, BLACK_THRESHOLD, WHITE_THRESHOLD)
-    
-    if curve_type == "sharp_left":
+        # 見失い中は白側にいるので右に急旋回
+        drive(CURVE_SPEED, 200)
+        integral = 0  # 積分項リセット
+    elif reflection < SHARP_LEFT_THRESHOLD:
         # 急左カーブ
-        robot.drive(BASE_SPEED * 0.5, -200)
+        lost_line_count = 0
+        drive(CURVE_SPEED, -200)
         integral = 0  # 積分項リセット
-    elif curve_type == "sharp_right":
+    elif reflection > SHARP_RIGHT_THRESHOLD:
         # 急右カーブ
-        robot.drive(BASE_SPEED * 0.5, 200)
+        lost_line_count = 0
+        drive(CURVE_SPEED, 200)
         integral = 0  # 積分項リセット
     else:
+        lost_line_count = 0
+        
         # ========== 通常のPID制御 ==========
         # PID制御の計算（レベル4で完全版）
-        turn_rate, error = calculate_pid_control(reflection, TARGET_VALUE, KP, KI, KD)
+        turn_rate, error = calculate_pid_control(reflection, TARGET_VALUE, KP_Q4, KI_Q8, KD_Q4)
         
         # 速度調整
         current_speed = adjust_speed(BASE_SPEED, error)
         
         # ロボットを駆動
-        robot.drive(current_speed, turn_rate)
+        drive(current_speed, turn_rate)
     
     wait(5)  # レベル4で高速化: 10ms → 5ms
 
 # 停止
 robot.stop()
-elapsed_time = timer.time() / 1000
-print(f"走行時間: {elapsed_time:.1f}秒")
+# 走行時間を整数演算で「秒.小数1桁」に整形（浮動小数点の書式処理を使わない）
+ms = timer.time()
+print("走行時間: ", ms // 1000, ".", (ms % 1000) // 100, "秒", sep="")
 print("PID制御による高性能ライントレース完了！")
 hub.speaker.beep(500, 200)
 
 # ========== レベル4で追加: 統計情報表示 ==========
 print(f"\n=== 統計情報 ===")
-print(f"最終積分値: {integral:.2f}")
-print(f"最終エラー: {last_error:.2f}")
+print(f"最終積分値: {integral}")
+print(f"最終エラー: {last_error}")
 hub.display.char("E")  # End
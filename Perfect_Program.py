@@ -9,7 +9,11 @@ from pybricks.hubs import PrimeHub
 from pybricks.pupdevices import Motor, ColorSensor
 from pybricks.parameters import Button, Color, Direction, Port, Stop
 from pybricks.robotics import DriveBase
-from pybricks.tools import wait, StopWatch
+from pybricks.tools import wait, StopWatch, multitask, run_task
+from array import array
+from micropython import const
+
+from calibration import calibrate_core
 
 # ハブとセンサーの初期化
 hub = PrimeHub()
@@ -28,6 +32,45 @@ wheel_diameter = 56  # 標準的なLEGOホイールの直径（実際の値に
 axle_track = 114     # 車軸間の距離（実際の値に調整してください）
 robot = DriveBase(left_motor, right_motor, wheel_diameter, axle_track)
 
+# 制御周期（ms）
+_CONTROL_PERIOD = const(5)
+
+# 駆動命令を省略する変化量の幅（速度 mm/s、旋回速度 deg/s、ロボットに合わせて調整）
+_DRIVE_SPEED_DEADBAND = const(3)
+_DRIVE_TURN_DEADBAND = const(5)
+
+# PIDカーネルが読み書きする可変状態のインデックス（定数はカーネルに即値として埋め込む）
+_PID_INTEGRAL = const(0)
+_PID_LAST_ERROR = const(1)
+_PID_OSCILLATING = const(2)
+_PID_DT_SCALE = const(3)  # 微分項の補正係数（Q8、周期どおりなら256）
+_PID_STATE_SIZE = const(4)
+
+# 整数演算のみのPIDカーネルのソース（目標値・ゲイン・制限値を即値として埋め込む）
+# キャリブレーション後にexecして生成し、stateの積分項と前回エラーを読み書きする
+_PID_SOURCE = """
+@micropython.viper
+def pid(sensor: int, state) -> int:
+    s = ptr32(state)
+    error = sensor - {target}
+    integral = s[{i_integral}] + error
+    if integral > {limit}:
+        integral = {limit}
+    elif integral < {neg_limit}:
+        integral = {neg_limit}
+    if s[{i_oscillating}]:
+        integral = integral >> 1
+    derivative = ((error - s[{i_last_error}]) * s[{i_dt_scale}]) >> 8
+    turn_rate = ({kp} * error + {ki} * integral + {kd} * derivative) >> 8
+    if turn_rate > {max_turn}:
+        turn_rate = {max_turn}
+    elif turn_rate < {neg_max_turn}:
+        turn_rate = {neg_max_turn}
+    s[{i_integral}] = integral
+    s[{i_last_error}] = error
+    return turn_rate
+"""
+
 class LineTracer:
     """高性能ライントレースクラス"""
     
@@ -35,25 +78,29 @@ class LineTracer:
         # センサーのキャリブレーション値
         self.black_threshold = 10  # 黒の反射率の閾値
         self.white_threshold = 85  # 白の反射率の閾値
-        self.target_value = (self.black_threshold + self.white_threshold) / 2
+        self.target_value = (self.black_threshold + self.white_threshold) // 2
         
         # PID制御パラメータ
         self.kp = 2.0   # 比例ゲイン（センサー1つなので少し高めに設定）
         self.ki = 0.02  # 積分ゲイン
         self.kd = 0.8   # 微分ゲイン
         
-        # PID制御用変数
-        self.integral = 0
-        self.last_error = 0
+        # PID制御用変数（積分項・前回エラーはpid_stateに保持）
         self.integral_limit = 100  # 積分項の上限
+        self.pid_state = array('i', [0] * _PID_STATE_SIZE)
         
         # 走行パラメータ
         self.base_speed = 150  # 基本速度 (mm/s)
         self.max_turn_rate = 250  # 最大回転速度 (deg/s)
         
-        # エラー履歴（振動検出用）
-        self.error_history = []
+        # エラー履歴（振動検出用、固定長のリングバッファ）
         self.history_size = 10
+        self.error_history = array('i', [0] * self.history_size)
+        self.error_idx = 0            # 次に書き込む位置
+        self._history_full = False    # 履歴が一周したか
+        self._sign_changes = 0        # 履歴内の符号変化の回数
+        self._last_sign = 0           # 直前のエラーの符号（0は未記録）
+        self._osc_threshold = int(self.history_size * 0.6)  # 振動と判定する符号変化の回数
         
         # タイマー
         self.timer = StopWatch()
@@ -63,130 +110,120 @@ class LineTracer:
         
         # ライン位置（左:-1、中央:0、右:1）
         self.line_position = 0
+        
+        self._prepare_control()
+    
+    def _prepare_control(self):
+        """PIDカーネルを生成し、制御ループで使う値を事前計算"""
+        self.pid_state[_PID_DT_SCALE] = 1 << 8
+        self._build_pid()
+        
+        # 制御ループ内で不変な閾値・速度を事前計算
+        self._sharp_left_thresh = self.black_threshold + 10
+        self._sharp_right_thresh = self.white_threshold - 10
+        self._lost_thresh = self.white_threshold + 5
+        self._curve_speed = self.base_speed // 2
+        self._curve_turn = self.max_turn_rate * 4 // 5
+        # 最大旋回時に40%減速する係数（Q8固定小数点）
+        self._slow_down_q8 = int(self.base_speed * 0.4 * 256 / self.max_turn_rate)
+    
+    def _build_pid(self):
+        """現在の目標値・ゲイン（Q8）・制限値を埋め込んだPIDカーネルを生成してself._pidに設定"""
+        src = _PID_SOURCE.format(
+            target=self.target_value,
+            kp=int(self.kp * 256),
+            ki=int(self.ki * 256),
+            kd=int(self.kd * 256),
+            limit=self.integral_limit,
+            neg_limit=-self.integral_limit,
+            max_turn=self.max_turn_rate,
+            neg_max_turn=-self.max_turn_rate,
+            i_integral=_PID_INTEGRAL,
+            i_last_error=_PID_LAST_ERROR,
+            i_oscillating=_PID_OSCILLATING,
+            i_dt_scale=_PID_DT_SCALE,
+        )
+        namespace = {}
+        exec(src, namespace)
+        self._pid = namespace["pid"]
     
     def calibrate(self):
         """センサーのキャリブレーション"""
-        print("=== キャリブレーション開始 ===")
         hub.display.char("C")
         
-        # 白色のキャリブレーション
-        hub.display.char("W")
-        hub.speaker.beep(1000, 100)
-        print("センサーを白い地面の上に置いてください")
-        print("中央ボタンを押してください")
-        
-        # ボタンが押されるまで現在の値を表示
-        while not Button.CENTER in hub.buttons.pressed():
-            current_value = color_sensor.reflection()
-            print(f"現在の反射率: {current_value}%", end='\r')
-            wait(50)
-        
-        white_value = color_sensor.reflection()
-        print(f"\n白の値: {white_value}%")
-        hub.speaker.beep(1500, 100)
-        wait(500)
-        
-        # 黒色のキャリブレーション
-        hub.display.char("B")
-        hub.speaker.beep(1000, 100)
-        print("センサーを黒いラインの上に置いてください")
-        print("中央ボタンを押してください")
-        
-        # ボタンが押されるまで現在の値を表示
-        while not Button.CENTER in hub.buttons.pressed():
-            current_value = color_sensor.reflection()
-            print(f"現在の反射率: {current_value}%", end='\r')
-            wait(50)
-        
-        black_value = color_sensor.reflection()
-        print(f"\n黒の値: {black_value}%")
-        hub.speaker.beep(1500, 100)
-        
-        # 閾値の計算と設定
-        self.black_threshold = black_value + 5
-        self.white_threshold = white_value - 5
-        self.target_value = (self.black_threshold + self.white_threshold) / 2
-        
-        # グレーゾーンの幅を計算（エッジ検出用）
-        self.gray_zone = (self.white_threshold - self.black_threshold) * 0.3
+        # 白黒の測定と閾値の計算（calibration.pyで共通化）
+        self.target_value, self.black_threshold, self.white_threshold = calibrate_core(
+            hub, color_sensor, include_thresholds=True)
         
-        print(f"目標値: {self.target_value}%")
-        print(f"黒閾値: {self.black_threshold}%")
-        print(f"白閾値: {self.white_threshold}%")
         print("=== キャリブレーション完了 ===")
+        wait(500)
         
-        hub.display.char("R")
-        hub.speaker.beep(2000, 200)
-        wait(1000)
-        
+        self._prepare_control()
         self.is_calibrated = True
     
+    @micropython.native
     def calculate_pid(self, sensor_value):
-        """PID制御の計算"""
+        """PID制御の計算（演算本体は生成したPIDカーネルで整数演算）"""
+        state = self.pid_state
+        
         # エラーの計算（センサー値と目標値の差）
         error = sensor_value - self.target_value
         
-        # エラー履歴の更新（振動検出用）
-        self.error_history.append(error)
-        if len(self.error_history) > self.history_size:
-            self.error_history.pop(0)
-        
-        # 積分項の計算（エラーの累積）
-        self.integral += error
-        
-        # 積分項の制限（ワインドアップ防止）
-        if self.integral > self.integral_limit:
-            self.integral = self.integral_limit
-        elif self.integral < -self.integral_limit:
-            self.integral = -self.integral_limit
-        
-        # 振動を検出したら積分項をリセット
-        if self.detect_oscillation():
-            self.integral *= 0.5
-        
-        # 微分項の計算（エラーの変化率）
-        derivative = error - self.last_error
-        
-        # PID出力の計算
-        turn_rate = (self.kp * error + 
-                    self.ki * self.integral + 
-                    self.kd * derivative)
+        # エラー履歴の更新と振動の有無をカーネルに渡す（積分項の半減に使用）
+        state[_PID_OSCILLATING] = self._record_error(error)
         
-        # 最大回転速度の制限
-        if turn_rate > self.max_turn_rate:
-            turn_rate = self.max_turn_rate
-        elif turn_rate < -self.max_turn_rate:
-            turn_rate = -self.max_turn_rate
+        # 単独で呼ぶ場合は周期どおりとみなす
+        state[_PID_DT_SCALE] = 1 << 8
         
-        # 次回のために現在のエラーを保存
-        self.last_error = error
-        
-        return turn_rate
+        return self._pid(sensor_value, state)
+    
+    @micropython.native
+    def _record_error(self, error):
+        """エラー履歴を更新し、符号変化の回数を差分で数える（振動中なら1を返す）"""
+        history = self.error_history
+        history_size = self.history_size
+        idx = self.error_idx
+        
+        # 一周後は最も古い値とその次の値の組が履歴から外れる
+        if self._history_full:
+            if (history[idx] >= 0) ^ (history[(idx + 1) % history_size] >= 0):
+                self._sign_changes -= 1
+        
+        # 直前のエラーと符号が変わっていればカウント
+        sign = 1 if error >= 0 else -1
+        if self._last_sign and sign != self._last_sign:
+            self._sign_changes += 1
+        self._last_sign = sign
+        
+        # 古い値を上書き
+        history[idx] = error
+        idx = (idx + 1) % history_size
+        if idx == 0:
+            self._history_full = True
+        self.error_idx = idx
+        
+        return 1 if self.detect_oscillation() else 0
     
+    @micropython.native
     def detect_oscillation(self):
         """振動の検出"""
-        if len(self.error_history) < self.history_size:
+        if not self._history_full:
             return False
         
-        # 符号の変化回数をカウント
-        sign_changes = 0
-        for i in range(1, len(self.error_history)):
-            if self.error_history[i] * self.error_history[i-1] < 0:
-                sign_changes += 1
-        
-        # 振動していると判定
-        return sign_changes > self.history_size * 0.6
+        # 符号変化の回数は_record_errorで差分更新済み
+        return self._sign_changes > self._osc_threshold
     
+    @micropython.native
     def detect_sharp_curve(self, sensor_value):
         """急カーブの検出"""
         # センサー値が極端に黒または白に近い場合は急カーブ
-        if sensor_value < self.black_threshold + 10:
+        if sensor_value < self._sharp_left_thresh:
             return "sharp_left"
-        elif sensor_value > self.white_threshold - 10:
+        elif sensor_value > self._sharp_right_thresh:
             return "sharp_right"
         return None
     
-    def search_line(self):
+    async def search_line(self):
         """ラインを見失った時の探索動作"""
         print("ラインを見失いました。探索中...")
         hub.display.char("?")
@@ -198,100 +235,174 @@ class LineTracer:
             search_pattern = [-30, 60, -90, 120, -150, 180]
         
         for angle in search_pattern:
-            robot.turn(angle)
+            # 旋回完了を待たずに、旋回しながらラインを確認
+            robot.turn(angle, wait=False)
             
-            # センサー値をチェック
-            reflection = color_sensor.reflection()
-            if reflection < self.target_value:
-                print("ラインを発見しました")
-                hub.speaker.beep(2000, 100)
-                hub.display.char("R")
-                # ラインの位置を更新
-                self.line_position = -1 if angle > 0 else 1
-                return True
+            while True:
+                # 旋回完了の判定は先に取り、完了後にも1回センサーを確認する
+                done = robot.done()
+                
+                # センサー値をチェック
+                reflection = await color_sensor.reflection()
+                if reflection < self.target_value:
+                    robot.stop()
+                    print("ラインを発見しました")
+                    await hub.speaker.beep(2000, 100)
+                    hub.display.char("R")
+                    return True
+                
+                if done:
+                    break
+                await wait(5)
             
-            wait(50)
+            await wait(50)
         
         # ラインが見つからない場合
         print("ラインが見つかりません")
         robot.stop()
-        hub.speaker.beep(500, 500)
+        await hub.speaker.beep(500, 500)
         hub.display.char("X")
         return False
     
-    def follow_line(self):
-        """ライントレース実行"""
-        if not self.is_calibrated:
-            print("先にキャリブレーションを実行してください")
-            self.calibrate()
-        
-        print("=== ライントレース開始 ===")
-        print("停止するには中央ボタンを押してください")
-        hub.display.char("G")
-        hub.speaker.beep(1500, 100)
-        
-        self.timer.reset()
+    async def sensor_task(self):
+        """センサー値を読み続け、最新値を保持するタスク"""
+        read_reflection = color_sensor.reflection
+        while True:
+            self._latest_reflection = await read_reflection()
+            # 制御タスクに実行を譲る
+            await wait(1)
+    
+    async def button_task(self):
+        """中央ボタンが押されるまで待つタスク（押されたら走行終了）"""
+        pressed = hub.buttons.pressed
+        CENTER = Button.CENTER
+        # ボタン集合の生成は制御周期ごとではなくこの周期でのみ行う
+        while not CENTER in pressed():
+            await wait(20)
+    
+    async def control_task(self):
+        """最新のセンサー値でPID制御を行うタスク"""
         lost_line_count = 0
         
+        # ループ内で使うメソッド・定数をローカル変数に取得（属性検索を削減）
+        drive = robot.drive
+        state = self.pid_state
+        pid = self._pid
+        record_error = self._record_error
+        lost_thresh = self._lost_thresh
+        sharp_left_thresh = self._sharp_left_thresh
+        sharp_right_thresh = self._sharp_right_thresh
+        curve_speed = self._curve_speed
+        curve_turn = self._curve_turn
+        base_speed = self.base_speed
+        slow_down_q8 = self._slow_down_q8
+        target = self.target_value
+        
+        # 固定周期で実行するためのスケジューラ
+        sched = StopWatch()
+        next_deadline = _CONTROL_PERIOD
+        last_pid_time = 0
+        
+        # 前回送った駆動命令（Noneは未送信）
+        last_speed = None
+        last_turn = 0
+        
         while True:
-            # 停止ボタンのチェック
-            if Button.CENTER in hub.buttons.pressed():
-                break
-            
-            # センサー値の取得
-            sensor_value = color_sensor.reflection()
+            # センサー値の取得（センサータスクが読んだ最新値）
+            sensor_value = self._latest_reflection
             
             # デバッグ情報の表示（必要に応じてコメントアウト）
             # print(f"反射率: {sensor_value}%", end='\r')
             
-            # ラインを完全に見失った場合の処理
-            if sensor_value > self.white_threshold + 5:
+            # 見失い・急カーブ・通常制御を1つの分岐で判定
+            if sensor_value > lost_thresh:
+                # ラインを完全に見失った場合の処理
                 lost_line_count += 1
                 if lost_line_count > 5:  # 連続して見失った場合
-                    if not self.search_line():
+                    # ライン位置は探索の直前に、最後のPIDエラーの符号から求める
+                    last_error = state[_PID_LAST_ERROR]
+                    self.line_position = -1 if last_error < 0 else (1 if last_error > 0 else 0)
+                    if not await self.search_line():
                         break
                     lost_line_count = 0
-            else:
+                    last_speed = None  # 探索で止まったので必ず再送する
+                # 見失い中は白側にいるので右に急旋回
+                speed = curve_speed
+                turn_rate = curve_turn
+                state[_PID_INTEGRAL] = 0  # 積分項リセット
+            elif sensor_value < sharp_left_thresh:
+                # 左に急旋回
                 lost_line_count = 0
-            
-            # 急カーブの検出と処理
-            curve_type = self.detect_sharp_curve(sensor_value)
-            if curve_type:
-                if curve_type == "sharp_left":
-                    # 左に急旋回
-                    robot.drive(self.base_speed * 0.5, -self.max_turn_rate * 0.8)
-                    self.line_position = -1
-                elif curve_type == "sharp_right":
-                    # 右に急旋回
-                    robot.drive(self.base_speed * 0.5, self.max_turn_rate * 0.8)
-                    self.line_position = 1
+                speed = curve_speed
+                turn_rate = -curve_turn
+                state[_PID_INTEGRAL] = 0  # 積分項リセット
+            elif sensor_value > sharp_right_thresh:
+                # 右に急旋回
+                lost_line_count = 0
+                speed = curve_speed
+                turn_rate = curve_turn
+                state[_PID_INTEGRAL] = 0  # 積分項リセット
             else:
-                # 通常のPID制御
-                turn_rate = self.calculate_pid(sensor_value)
-                
-                # 速度の調整（カーブで減速）
-                speed_factor = 1 - (abs(turn_rate) / self.max_turn_rate) * 0.4
-                current_speed = self.base_speed * speed_factor
+                lost_line_count = 0
                 
-                # ロボットの駆動
-                robot.drive(current_speed, turn_rate)
+                # 通常のPID制御（calculate_pidをインライン展開）
+                error = sensor_value - target
+                state[_PID_OSCILLATING] = record_error(error)
+                now = sched.time()
+                dt = now - last_pid_time
+                last_pid_time = now
+                # 周期が延びた場合は微分項を実際の経過時間で正規化する（viperは除算不可のためここで計算）
+                state[_PID_DT_SCALE] = (_CONTROL_PERIOD << 8) // dt if dt > _CONTROL_PERIOD else 1 << 8
+                turn_rate = pid(sensor_value, state)
                 
-                # ライン位置の更新
-                if abs(sensor_value - self.target_value) < self.gray_zone:
-                    self.line_position = 0  # 中央
-                elif sensor_value < self.target_value:
-                    self.line_position = -1  # 左
-                else:
-                    self.line_position = 1  # 右
+                # 速度の調整（カーブで減速）
+                speed = base_speed - ((abs(turn_rate) * slow_down_q8) >> 8)
+            
+            # ロボットの駆動（指令値がほとんど変わらない場合は省略、
+            # 新しい命令が来るまで前回の命令で走り続ける）
+            if (last_speed is None
+                    or abs(speed - last_speed) > _DRIVE_SPEED_DEADBAND
+                    or abs(turn_rate - last_turn) > _DRIVE_TURN_DEADBAND):
+                drive(speed, turn_rate)
+                last_speed = speed
+                last_turn = turn_rate
             
-            # 制御周期の待機
-            wait(5)  # より高速な制御ループ
+            # 次の周期まで待機（待機中はセンサータスクが動く）
+            remaining = next_deadline - sched.time()
+            if remaining > 0:
+                await wait(remaining)
+                next_deadline += _CONTROL_PERIOD
+            else:
+                # 処理が周期を超えた場合は追いつこうとせず基準を取り直す
+                next_deadline = sched.time() + _CONTROL_PERIOD
+                # 他のタスクにも実行を譲り、センサー値と停止ボタンを更新させる
+                await wait(0)
+    
+    def follow_line(self):
+        """ライントレース実行"""
+        if not self.is_calibrated:
+            print("先にキャリブレーションを実行してください")
+            self.calibrate()
+        
+        print("=== ライントレース開始 ===")
+        print("停止するには中央ボタンを押してください")
+        hub.display.char("G")
+        hub.speaker.beep(1500, 100)
+        
+        self.timer.reset()
+        self._latest_reflection = self.target_value
+        
+        # センサー読み取り・制御・停止ボタン監視を並行実行
+        # （いずれかのタスクが終了したら全タスクを止める）
+        run_task(multitask(self.sensor_task(), self.control_task(),
+                           self.button_task(), race=True))
         
         # 停止処理
         robot.stop()
-        elapsed_time = self.timer.time() / 1000
+        ms = self.timer.time()
         print(f"\n=== ライントレース終了 ===")
-        print(f"走行時間: {elapsed_time:.2f}秒")
+        # 走行時間を整数演算で「秒.小数2桁」に整形（浮動小数点の書式処理を使わない）
+        print("走行時間: ", ms // 1000, ".", "{:02d}".format((ms % 1000) // 10), "秒", sep="")
         hub.display.char("S")
         hub.speaker.beep(1000, 200)
     
@@ -300,9 +411,12 @@ class LineTracer:
         print("=== センサーテストモード ===")
         print("中央ボタンで終了")
         hub.display.char("T")
+        read_reflection = color_sensor.reflection
+        pressed = hub.buttons.pressed
+        CENTER = Button.CENTER
         
-        while not Button.CENTER in hub.buttons.pressed():
-            reflection = color_sensor.reflection()
+        while not CENTER in pressed():
+            reflection = read_reflection()
             color = color_sensor.color()
             
             # 反射率に基づいて表示を変更
@@ -357,6 +471,7 @@ class LineTracer:
             
             wait(10)
         
+        self._prepare_control()
         hub.speaker.beep(2000, 200)
         print("設定完了")
         print(f"最終設定 - Kp: {self.kp:.1f}, 速度: {self.base_speed}")
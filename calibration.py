@@ -0,0 +1,72 @@
+"""
+キャリブレーション共通モジュール
+レベル2〜4とPerfect_Programで共有する白黒の測定処理
+"""
+
+from pybricks.parameters import Button
+from pybricks.tools import wait
+
+@micropython.native
+def calibrate_core(hub, color_sensor, include_thresholds=False):
+    """
+    白と黒の値を測定して、目標値を計算する
+    include_thresholds=Trueの場合は黒・白の値の代わりに
+    ライン検出用の閾値（黒+5、白-5）を返す
+    """
+    print("=== キャリブレーション開始 ===")
+    read_reflection = color_sensor.reflection
+    pressed = hub.buttons.pressed
+    CENTER = Button.CENTER
+    
+    # 白の測定
+    hub.display.char("W")
+    print("白い地面にセンサーを置いて中央ボタンを押してください")
+    tick = 0
+    while not CENTER in pressed():
+        # 表示は200msごとに間引く（シリアル出力は時間がかかるため）
+        if tick % 2 == 0:
+            current = read_reflection()
+            print("現在の値:", current, "%", end='\r')
+        tick += 1
+        wait(100)  # ボタン待ちの確認は100msごとで十分
+    
+    white_value = read_reflection()
+    print(f"\n白の値: {white_value}%")
+    hub.speaker.beep(1000, 100)
+    wait(500)
+    
+    # 黒の測定
+    hub.display.char("B")
+    print("黒いラインにセンサーを置いて中央ボタンを押してください")
+    tick = 0
+    while not CENTER in pressed():
+        # 表示は200msごとに間引く（シリアル出力は時間がかかるため）
+        if tick % 2 == 0:
+            current = read_reflection()
+            print("現在の値:", current, "%", end='\r')
+        tick += 1
+        wait(100)  # ボタン待ちの確認は100msごとで十分
+    
+    black_value = read_reflection()
+    print(f"\n黒の値: {black_value}%")
+    hub.speaker.beep(1500, 100)
+    
+    # 目標値を計算（整数で保持）
+    # 切り上げておくと「reflection < target」の判定が元の小数の中間値と一致する
+    target = (white_value + black_value + 1) // 2
+    print(f"目標値: {target}%")
+    
+    if include_thresholds:
+        # ライン検出用の閾値
+        black_threshold = black_value + 5
+        white_threshold = white_value - 5
+        print(f"黒閾値: {black_threshold}%, 白閾値: {white_threshold}%")
+        result = (target, black_threshold, white_threshold)
+    else:
+        result = (target, black_value, white_value)
+    
+    hub.display.char("R")
+    hub.speaker.beep(2000, 200)
+    wait(500)
+    
+    return result
@@ -0,0 +1,6 @@
+# Pybricksファームウェアに凍結バイトコード（.mpy）として組み込むモジュール
+# ファームウェアのビルド時に FROZEN_MANIFEST にこのファイルを指定する
+# Perfect_Program.py は __main__ のときだけ main() を呼ぶので、凍結しても読み込みだけでは走らない
+# Level2〜4のプログラムは読み込んだ時点で走行を始めるスクリプトなので凍結しない
+module("calibration.py", opt=3)
+module("Perfect_Program.py", opt=3)